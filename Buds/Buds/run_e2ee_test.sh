@@ -16,13 +16,13 @@ echo -n "Paste Firebase ID Token here: "
 read FIREBASE_TOKEN
 
 echo ""
-echo "STEP 2: Update test script"
+echo "STEP 2: Export token"
 echo "-------------------------------------------"
 
-# Use sed to update the token in the test file
-sed -i '' "s/FIREBASE_ID_TOKEN = None/FIREBASE_ID_TOKEN = \"$FIREBASE_TOKEN\"/" test_e2ee_single_device.py
+# The test script reads the token from the environment
+export FIREBASE_ID_TOKEN="$FIREBASE_TOKEN"
 
-echo "✅ Token updated in test_e2ee_single_device.py"
+echo "✅ FIREBASE_ID_TOKEN exported for test_e2ee_single_device.py"
 echo ""
 echo "STEP 3: Run the test"
 echo "-------------------------------------------"
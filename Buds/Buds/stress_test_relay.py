@@ -6,36 +6,77 @@ Relay Stress Test
 Simulates 1000 users sending 10,000 messages/day to test relay performance.
 
 Tests:
-- D1 write throughput (message inserts)
+- D1 write throughput (message inserts, batched via /api/messages/send:batch)
 - D1 read throughput (inbox queries)
 - Worker CPU under load
 - Rate limiting effectiveness
 - APNs delivery (if configured)
 
 Requirements:
-- pip install requests asyncio aiohttp
+- pip install requests asyncio aiohttp numpy
+- Optional: pip install 'httpx[http2]' (multiplexes inbox polls over HTTP/2)
+- Optional: pip install orjson (faster JSON encode/decode)
 - Firebase ID token
 """
 
 import asyncio
 import aiohttp
+import numpy as np
 import time
 import random
 import hashlib
 import base64
+import json
+import os
+import ssl
+import uuid
+from itertools import islice
 from typing import List, Dict
 from dataclasses import dataclass
 from collections import defaultdict
 
+try:
+    import httpx
+except ImportError:
+    httpx = None
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+if orjson is not None:
+    def _json_dumps(obj) -> str:
+        return orjson.dumps(obj).decode('utf-8')
+    _json_loads = orjson.loads
+else:
+    _json_dumps = json.dumps
+    _json_loads = json.loads
+
 # Configuration
 RELAY_URL = "https://buds-relay-production.ericyarmolinsky.workers.dev"
-FIREBASE_ID_TOKEN = None  # Paste from Xcode logs
+FIREBASE_ID_TOKEN = os.environ.get("FIREBASE_ID_TOKEN")  # From Xcode logs
 
 # Test parameters
 NUM_USERS = 100  # Simulated users (start small, scale up)
 NUM_MESSAGES = 1000  # Total messages to send
 CONCURRENCY = 10  # Parallel requests
+SEND_BATCH_SIZE = 32  # Messages per /api/messages/send:batch request
+SEND_FLUSHERS = 4  # Background tasks draining send_message's queue
+SEND_FLUSH_WINDOW = 0.01  # Seconds a flusher waits to fill a batch
 INBOX_POLL_INTERVAL = 5  # Seconds between inbox polls
+INBOX_MULTI_MAX_DIDS = 90  # DIDs per /api/messages/inbox:multi (D1 caps bound params at 100)
+
+# Strips every non-digit ASCII character in one C-level str.translate call
+_NON_DIGITS = str.maketrans('', '', ''.join(chr(c) for c in range(128) if not chr(c).isdigit()))
+
+
+def _make_ssl_ctx() -> ssl.SSLContext:
+    """TLS context for one HTTP client: TLS 1.2+ with ECDHE+AES-GCM, TLS 1.3 when offered"""
+    ctx = ssl.create_default_context()
+    ctx.minimum_version = ssl.TLSVersion.TLSv1_2
+    ctx.set_ciphers('ECDHE+AESGCM')
+    return ctx
 
 
 @dataclass
@@ -55,6 +96,60 @@ class RelayStressTester:
         self.relay_url = relay_url
         self.firebase_token = firebase_token
         self.users: List[SimUser] = []
+
+        # One pooled session for the whole run so requests reuse
+        # keep-alive connections instead of paying TCP+TLS+DNS each time.
+        # keepalive_timeout matches the common 75s server idle timeout.
+        # No TCP_NODELAY hook needed: asyncio sets it on every TCP transport.
+        self._connector = aiohttp.TCPConnector(
+            limit=CONCURRENCY * 4,
+            limit_per_host=CONCURRENCY * 4,
+            use_dns_cache=True,
+            ttl_dns_cache=300,
+            keepalive_timeout=75,
+            enable_cleanup_closed=True,
+            ssl=_make_ssl_ctx()
+        )
+        self._session = aiohttp.ClientSession(
+            connector=self._connector,
+            headers={"Authorization": f"Bearer {self.firebase_token}"},
+            timeout=aiohttp.ClientTimeout(total=30),
+            json_serialize=_json_dumps
+        )
+        self._batch_supported = True
+        self._send_queue: asyncio.Queue = asyncio.Queue()
+        self._flushers: List[asyncio.Task] = []
+        self._inbox_multi_supported = True
+
+        # The relay only stores ciphertext, so payload bytes don't need to
+        # differ per message; generate them once instead of per send
+        self._fake_payload = self._random_b64(700)
+        self._fake_sig = self._random_b64(64)
+        key_blob = os.urandom(64 * 92)
+        self._wrapped_key_pool = [
+            base64.b64encode(key_blob[i:i + 92]).decode('ascii')
+            for i in range(0, len(key_blob), 92)
+        ]
+
+        # Inbox polls fan out to every user each tick; over HTTP/2 they
+        # multiplex on a handful of connections instead of one socket each
+        self._h2 = None
+        self._inbox_http_version = None
+        if httpx is not None:
+            try:
+                self._h2 = httpx.AsyncClient(
+                    http2=True,
+                    base_url=self.relay_url,
+                    headers={"Authorization": f"Bearer {self.firebase_token}"},
+                    limits=httpx.Limits(max_connections=4, max_keepalive_connections=4),
+                    # Own context: httpcore sets ALPN (h2) on it, which
+                    # must not leak into aiohttp's HTTP/1.1-only connections
+                    verify=_make_ssl_ctx(),
+                    timeout=30
+                )
+            except ImportError:
+                # httpx installed without the h2 extra
+                self._h2 = None
         self.metrics = {
             'register_success': 0,
             'register_failed': 0,
@@ -62,31 +157,66 @@ class RelayStressTester:
             'send_failed': 0,
             'inbox_success': 0,
             'inbox_failed': 0,
-            'total_latency': defaultdict(list),
+            'inbox_messages': 0,
+            # Failures are tallied here and reported once in print_metrics;
+            # printing per failure serializes bursts of coroutines on stdout
+            'errors': defaultdict(int),
+            'last_error': {},
         }
 
-    async def setup_users(self, num_users: int):
+        # Latency samples (ms) per operation in preallocated float32 buffers,
+        # filled up to self._lat_i[op]; buffers double if a phase overruns them
+        self._lat = {
+            'register': np.empty(NUM_USERS, np.float32),
+            'send': np.empty(NUM_MESSAGES, np.float32),
+            'send_batch': np.empty(-(-NUM_MESSAGES // SEND_BATCH_SIZE), np.float32),
+            'inbox': np.empty(NUM_USERS, np.float32),
+            'inbox_multi': np.empty(-(-NUM_USERS // INBOX_MULTI_MAX_DIDS), np.float32),
+        }
+        self._lat_i = defaultdict(int)
+
+    async def setup(self):
+        """Start the background flushers behind send_message (started lazily on first send)"""
+        if self._flushers:
+            return
+        self._flushers = [
+            asyncio.create_task(self._flush_sends())
+            for _ in range(SEND_FLUSHERS)
+        ]
+
+    async def setup_users(self, num_users: int, concurrency: int = CONCURRENCY):
         """Create and register simulated users"""
         print(f"📝 Creating {num_users} simulated users...")
 
+        # One entropy read for every fake pubkey: 32 bytes X25519 + 32 bytes Ed25519 per user
+        blob = os.urandom(num_users * 64)
+        phone_hashes = [self._hash_phone(f"+1555000{i:04d}") for i in range(num_users)]
+
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def register_with_limit(user: SimUser):
+            async with semaphore:
+                return await self.register_user(user)
+
         tasks = []
         for i in range(num_users):
+            offset = i * 64
             user = SimUser(
                 did=f"did:buds:test{i:05d}",
                 device_id=self._uuid(),
-                phone_hash=self._hash_phone(f"+1555000{i:04d}"),
-                pubkey_x25519=self._random_b64(32),
-                pubkey_ed25519=self._random_b64(32)
+                phone_hash=phone_hashes[i],
+                pubkey_x25519=base64.b64encode(blob[offset:offset + 32]).decode('ascii'),
+                pubkey_ed25519=base64.b64encode(blob[offset + 32:offset + 64]).decode('ascii')
             )
             self.users.append(user)
-            tasks.append(self.register_user(user))
+            tasks.append(register_with_limit(user))
 
-        # Register users in parallel
+        # Register users in parallel, bounded so we don't open num_users sockets at once
         start = time.time()
         results = await asyncio.gather(*tasks, return_exceptions=True)
         elapsed = time.time() - start
 
-        success = sum(1 for r in results if not isinstance(r, Exception))
+        success = sum(1 for r in results if r is True)
         failed = len(results) - success
 
         print(f"✅ Registered {success}/{num_users} users in {elapsed:.2f}s")
@@ -104,42 +234,37 @@ class RelayStressTester:
             "pubkey_ed25519": user.pubkey_ed25519
         }
 
-        async with aiohttp.ClientSession() as session:
-            headers = {"Authorization": f"Bearer {self.firebase_token}"}
-            start = time.time()
+        start = time.time()
 
-            try:
-                async with session.post(
-                    f"{self.relay_url}/api/devices/register",
-                    json=payload,
-                    headers=headers
-                ) as resp:
-                    latency = (time.time() - start) * 1000
-                    self.metrics['total_latency']['register'].append(latency)
-
-                    if resp.status == 201:
-                        self.metrics['register_success'] += 1
-                        return True
-                    else:
-                        self.metrics['register_failed'] += 1
-                        print(f"❌ Register failed: {resp.status}")
-                        return False
-
-            except Exception as e:
-                self.metrics['register_failed'] += 1
-                print(f"❌ Register error: {e}")
-                return False
-
-    async def send_message(self, sender: SimUser, recipients: List[SimUser]):
-        """Send E2EE message"""
+        try:
+            async with self._session.post(
+                f"{self.relay_url}/api/devices/register",
+                json=payload
+            ) as resp:
+                latency = (time.time() - start) * 1000
+                self._record_latency('register', latency)
+
+                if resp.status == 201:
+                    self.metrics['register_success'] += 1
+                    return True
+                else:
+                    self.metrics['register_failed'] += 1
+                    self._record_error('register', resp.status)
+                    return False
+
+        except Exception as e:
+            self.metrics['register_failed'] += 1
+            self._record_error('register', type(e).__name__, str(e))
+            return False
+
+    def build_message(self, sender: SimUser, recipients: List[SimUser]) -> Dict:
+        """Build a fake E2EE message envelope"""
         message_id = self._uuid()
         receipt_cid = f"bafyrei{self._random_b64(30).lower()}"
 
         # Simulate wrapped keys (one per recipient device)
-        wrapped_keys = {
-            r.device_id: self._random_b64(92)
-            for r in recipients
-        }
+        keys = random.choices(self._wrapped_key_pool, k=len(recipients))
+        wrapped_keys = {r.device_id: key for r, key in zip(recipients, keys)}
 
         payload = {
             "message_id": message_id,
@@ -147,87 +272,258 @@ class RelayStressTester:
             "sender_did": sender.did,
             "sender_device_id": sender.device_id,
             "recipient_dids": [r.did for r in recipients],
-            "encrypted_payload": self._random_b64(700),  # ~500 KB encrypted
+            "encrypted_payload": self._fake_payload,  # ~500 KB encrypted
             "wrapped_keys": wrapped_keys,
-            "signature": self._random_b64(88)  # Ed25519 signature
+            "signature": self._fake_sig  # Ed25519 signature
         }
+        return payload
+
+    async def send_message(self, sender: SimUser, recipients: List[SimUser]) -> bool:
+        """Send E2EE message, coalesced with concurrent sends into one batch request"""
+        await self.setup()
+        result = asyncio.get_running_loop().create_future()
+        await self._send_queue.put((self.build_message(sender, recipients), result))
+        return await result
+
+    async def _flush_sends(self):
+        """Drain queued messages into /api/messages/send:batch requests"""
+        while True:
+            batch = []
+            try:
+                batch.append(await self._send_queue.get())
+                deadline = time.monotonic() + SEND_FLUSH_WINDOW
+
+                # Collect up to SEND_BATCH_SIZE messages or until the window closes.
+                # Poll with get_nowait() so a timeout can never swallow a dequeued item.
+                while len(batch) < SEND_BATCH_SIZE:
+                    try:
+                        batch.append(self._send_queue.get_nowait())
+                    except asyncio.QueueEmpty:
+                        if time.monotonic() >= deadline:
+                            break
+                        await asyncio.sleep(SEND_FLUSH_WINDOW / 10)
+
+                outcomes = await self._send_batch([envelope for envelope, _ in batch])
+                for (_, result), ok in zip(batch, outcomes):
+                    if not result.done():
+                        result.set_result(ok)
+            except asyncio.CancelledError:
+                for _, result in batch:
+                    result.cancel()
+                raise
+            finally:
+                for _ in batch:
+                    self._send_queue.task_done()
+
+    async def _post_message(self, payload: Dict) -> bool:
+        """POST a single envelope to /api/messages/send"""
+        start = time.time()
 
-        async with aiohttp.ClientSession() as session:
-            headers = {"Authorization": f"Bearer {self.firebase_token}"}
-            start = time.time()
+        try:
+            async with self._session.post(
+                f"{self.relay_url}/api/messages/send",
+                json=payload
+            ) as resp:
+                latency = (time.time() - start) * 1000
+                self._record_latency('send', latency)
+
+                if resp.status == 201:
+                    self.metrics['send_success'] += 1
+                    return True
+                else:
+                    self.metrics['send_failed'] += 1
+                    text = await resp.text()
+                    self._record_error('send', resp.status, text)
+                    return False
+
+        except Exception as e:
+            self.metrics['send_failed'] += 1
+            self._record_error('send', type(e).__name__, str(e))
+            return False
+
+    async def send_messages_batch(self, envelopes: List[Dict]) -> int:
+        """Send several E2EE messages in one request, returns number accepted"""
+        return sum(await self._send_batch(envelopes))
+
+    async def _send_batch(self, envelopes: List[Dict]) -> List[bool]:
+        """POST envelopes to /api/messages/send:batch, returns each envelope's outcome"""
+        if not self._batch_supported:
+            return list(await asyncio.gather(*(self._post_message(e) for e in envelopes)))
 
-            try:
-                async with session.post(
-                    f"{self.relay_url}/api/messages/send",
-                    json=payload,
-                    headers=headers
-                ) as resp:
-                    latency = (time.time() - start) * 1000
-                    self.metrics['total_latency']['send'].append(latency)
-
-                    if resp.status == 201:
-                        self.metrics['send_success'] += 1
-                        return True
-                    else:
-                        self.metrics['send_failed'] += 1
-                        text = await resp.text()
-                        print(f"❌ Send failed: {resp.status} - {text[:100]}")
-                        return False
-
-            except Exception as e:
-                self.metrics['send_failed'] += 1
-                print(f"❌ Send error: {e}")
-                return False
-
-    async def poll_inbox(self, user: SimUser):
-        """Poll inbox for new messages"""
-        async with aiohttp.ClientSession() as session:
-            headers = {"Authorization": f"Bearer {self.firebase_token}"}
-            start = time.time()
+        start = time.time()
+        fall_back = False
+
+        try:
+            async with self._session.post(
+                f"{self.relay_url}/api/messages/send:batch",
+                json={"messages": envelopes}
+            ) as resp:
+                latency = (time.time() - start) * 1000
+                self._record_latency('send_batch', latency)
+
+                if resp.status == 201:
+                    self.metrics['send_success'] += len(envelopes)
+                    return [True] * len(envelopes)
+                elif resp.status == 404:
+                    fall_back = True
+                else:
+                    self.metrics['send_failed'] += len(envelopes)
+                    text = await resp.text()
+                    self._record_error('send_batch', resp.status, text)
+                    return [False] * len(envelopes)
+
+        except Exception as e:
+            self.metrics['send_failed'] += len(envelopes)
+            self._record_error('send_batch', type(e).__name__, str(e))
+            return [False] * len(envelopes)
+
+        # Relay predates the batch endpoint, fall back to single sends once the
+        # 404 response has released its connection back to the pool
+        if fall_back:
+            if self._batch_supported:
+                print("⚠️  Batch endpoint not available, sending individually")
+                self._batch_supported = False
+            return await self._send_batch(envelopes)
+
+    async def poll_inbox(self, user: SimUser) -> int:
+        """Poll inbox for new messages, returns the pending message count"""
+        if self._h2 is not None:
+            return await self._poll_inbox_h2(user)
 
-            try:
-                async with session.get(
-                    f"{self.relay_url}/api/messages/inbox?did={user.did}&limit=50",
-                    headers=headers
-                ) as resp:
-                    latency = (time.time() - start) * 1000
-                    self.metrics['total_latency']['inbox'].append(latency)
-
-                    if resp.status == 200:
-                        self.metrics['inbox_success'] += 1
-                        data = await resp.json()
-                        return data.get('messages', [])
-                    else:
-                        self.metrics['inbox_failed'] += 1
-                        return []
-
-            except Exception as e:
+        start = time.time()
+
+        try:
+            async with self._session.get(
+                f"{self.relay_url}/api/messages/inbox?did={user.did}&limit=50&summary=1"
+            ) as resp:
+                latency = (time.time() - start) * 1000
+                self._record_latency('inbox', latency)
+                self._inbox_http_version = f"HTTP/{resp.version.major}.{resp.version.minor}"
+
+                if resp.status == 200:
+                    self.metrics['inbox_success'] += 1
+                    data = _json_loads(await resp.read())
+                    return self._count_inbox(data.get('count', 0))
+                else:
+                    self.metrics['inbox_failed'] += 1
+                    self._record_error('inbox', resp.status)
+                    return 0
+
+        except Exception as e:
+            self.metrics['inbox_failed'] += 1
+            self._record_error('inbox', type(e).__name__, str(e))
+            return 0
+
+    async def _poll_inbox_h2(self, user: SimUser) -> int:
+        """Poll inbox over the shared HTTP/2 client"""
+        start = time.time()
+
+        try:
+            resp = await self._h2.get(
+                "/api/messages/inbox",
+                params={"did": user.did, "limit": 50, "summary": 1}
+            )
+            latency = (time.time() - start) * 1000
+            self._record_latency('inbox', latency)
+            self._inbox_http_version = resp.http_version
+
+            if resp.status_code == 200:
+                self.metrics['inbox_success'] += 1
+                data = _json_loads(resp.content)
+                return self._count_inbox(data.get('count', 0))
+            else:
                 self.metrics['inbox_failed'] += 1
-                print(f"❌ Inbox error: {e}")
-                return []
+                self._record_error('inbox', resp.status_code)
+                return 0
+
+        except Exception as e:
+            self.metrics['inbox_failed'] += 1
+            self._record_error('inbox', type(e).__name__, str(e))
+            return 0
+
+    async def poll_inbox_multi(self, users: List[SimUser]) -> Dict[str, int]:
+        """Poll many inboxes with one request per INBOX_MULTI_MAX_DIDS users"""
+        if not self._inbox_multi_supported:
+            results = await asyncio.gather(*(self.poll_inbox(u) for u in users))
+            return {u.did: count for u, count in zip(users, results)}
+
+        chunks = [
+            users[i:i + INBOX_MULTI_MAX_DIDS]
+            for i in range(0, len(users), INBOX_MULTI_MAX_DIDS)
+        ]
+        inboxes: Dict[str, int] = {}
+        for chunk_inboxes in await asyncio.gather(*(self._poll_inbox_chunk(c) for c in chunks)):
+            inboxes.update(chunk_inboxes)
+        return inboxes
+
+    async def _poll_inbox_chunk(self, users: List[SimUser]) -> Dict[str, int]:
+        """POST one chunk of DIDs to /api/messages/inbox:multi"""
+        start = time.time()
+        fall_back = False
+
+        try:
+            async with self._session.post(
+                f"{self.relay_url}/api/messages/inbox:multi",
+                json={"dids": [u.did for u in users], "limit": 50, "summary": True}
+            ) as resp:
+                latency = (time.time() - start) * 1000
+
+                if resp.status == 200:
+                    self._record_latency('inbox_multi', latency)
+                    data = _json_loads(await resp.read())
+                    # One success per inbox so rates stay comparable to single polls
+                    self.metrics['inbox_success'] += len(users)
+                    return {u.did: self._count_inbox(data.get(u.did, 0)) for u in users}
+                elif resp.status == 404:
+                    fall_back = True
+                else:
+                    self._record_latency('inbox_multi', latency)
+                    self.metrics['inbox_failed'] += len(users)
+                    self._record_error('inbox_multi', resp.status)
+                    return {}
+
+        except Exception as e:
+            self.metrics['inbox_failed'] += len(users)
+            self._record_error('inbox_multi', type(e).__name__, str(e))
+            return {}
+
+        # Relay predates the multi-inbox endpoint, fall back to per-DID polls
+        # once the 404 response has released its connection back to the pool
+        if fall_back:
+            if self._inbox_multi_supported:
+                print("⚠️  Multi-inbox endpoint not available, polling individually")
+                self._inbox_multi_supported = False
+            return await self.poll_inbox_multi(users)
 
     async def stress_test_sends(self, num_messages: int, concurrency: int):
-        """Send messages with controlled concurrency"""
-        print(f"\n📤 Sending {num_messages} messages (concurrency: {concurrency})...")
+        """Send messages in batches with controlled concurrency"""
+        print(f"\n📤 Sending {num_messages} messages "
+              f"(batch: {SEND_BATCH_SIZE}, concurrency: {concurrency})...")
+
+        envelopes = []
+        for _ in range(num_messages):
+            sender = random.choice(self.users)
+            # Simulate Circle size: 2-12 members
+            circle_size = random.randint(2, min(12, len(self.users)))
+            recipients = random.sample(self.users, circle_size)
+            envelopes.append(self.build_message(sender, recipients))
+
+        it = iter(envelopes)
+        batches = list(iter(lambda: list(islice(it, SEND_BATCH_SIZE)), []))
 
         semaphore = asyncio.Semaphore(concurrency)
-        tasks = []
 
-        async def send_with_limit():
+        async def send_with_limit(batch: List[Dict]):
             async with semaphore:
-                sender = random.choice(self.users)
-                # Simulate Circle size: 2-12 members
-                circle_size = random.randint(2, min(12, len(self.users)))
-                recipients = random.sample(self.users, circle_size)
-                return await self.send_message(sender, recipients)
+                return await self.send_messages_batch(batch)
 
         start = time.time()
-        tasks = [send_with_limit() for _ in range(num_messages)]
+        tasks = [send_with_limit(batch) for batch in batches]
         results = await asyncio.gather(*tasks, return_exceptions=True)
         elapsed = time.time() - start
 
-        success = sum(1 for r in results if r is True)
-        print(f"✅ Sent {success}/{num_messages} messages in {elapsed:.2f}s")
+        success = sum(r for r in results if isinstance(r, int))
+        print(f"✅ Sent {success}/{num_messages} messages in {len(batches)} batches ({elapsed:.2f}s)")
         print(f"   Throughput: {success/elapsed:.2f} msg/s")
 
     async def stress_test_inbox_polling(self, duration_seconds: int):
@@ -236,16 +532,20 @@ class RelayStressTester:
 
         start = time.time()
         total_polls = 0
+        success_before = self.metrics['inbox_success']
 
         while time.time() - start < duration_seconds:
-            tasks = [self.poll_inbox(user) for user in self.users]
-            await asyncio.gather(*tasks, return_exceptions=True)
+            await self.poll_inbox_multi(self.users)
             total_polls += len(self.users)
             await asyncio.sleep(INBOX_POLL_INTERVAL)
 
         elapsed = time.time() - start
-        print(f"✅ Completed {total_polls} inbox polls in {elapsed:.2f}s")
-        print(f"   Throughput: {total_polls/elapsed:.2f} polls/s")
+        success = self.metrics['inbox_success'] - success_before
+        print(f"✅ Completed {success}/{total_polls} inbox polls in {elapsed:.2f}s")
+        print(f"   Throughput: {success/elapsed:.2f} polls/s")
+        if self._inbox_http_version:
+            print(f"   Protocol: {self._inbox_http_version}")
+        print(f"   Pending messages seen: {self.metrics['inbox_messages']}")
 
     def print_metrics(self):
         """Print test metrics"""
@@ -261,33 +561,77 @@ class RelayStressTester:
 
         # Latency percentiles
         print("\n⏱️  Latency (ms):")
-        for op, latencies in self.metrics['total_latency'].items():
-            if not latencies:
+        for op, buf in self._lat.items():
+            n = self._lat_i[op]
+            if n == 0:
                 continue
 
-            latencies.sort()
-            p50 = latencies[len(latencies) // 2]
-            p95 = latencies[int(len(latencies) * 0.95)]
-            p99 = latencies[int(len(latencies) * 0.99)]
-            avg = sum(latencies) / len(latencies)
+            latencies = buf[:n]
+            p50, p95, p99 = np.percentile(latencies, [50, 95, 99])
+            avg = float(latencies.mean())
 
             print(f"   {op.capitalize():10} - avg: {avg:6.2f}ms  p50: {p50:6.2f}ms  p95: {p95:6.2f}ms  p99: {p99:6.2f}ms")
 
+        # Error breakdown
+        if self.metrics['errors']:
+            print("\n❌ Errors:")
+            top = sorted(self.metrics['errors'].items(), key=lambda kv: kv[1], reverse=True)[:10]
+            for (op, code), count in top:
+                print(f"   {op:12} {str(code):20} x{count}")
+            for op, detail in self.metrics['last_error'].items():
+                print(f"   Last {op} error: {detail}")
+
         print("\n" + "=" * 70)
 
+    async def aclose(self):
+        """Stop the send flushers and close the shared HTTP clients"""
+        for task in self._flushers:
+            task.cancel()
+        await asyncio.gather(*self._flushers, return_exceptions=True)
+        self._flushers = []
+
+        # Messages still queued will never be flushed; release their callers
+        while not self._send_queue.empty():
+            _, result = self._send_queue.get_nowait()
+            result.cancel()
+            self._send_queue.task_done()
+
+        await self._session.close()
+        if self._h2 is not None:
+            await self._h2.aclose()
+
     # Helpers
 
+    def _count_inbox(self, inbox) -> int:
+        """Add one inbox's pending count (or full message list) to the metrics"""
+        count = inbox if isinstance(inbox, int) else len(inbox)
+        self.metrics['inbox_messages'] += count
+        return count
+
+    def _record_latency(self, op: str, latency: float):
+        """Store one latency sample (ms), growing the op's buffer when full"""
+        i = self._lat_i[op]
+        buf = self._lat[op]
+        if i == len(buf):
+            buf = self._lat[op] = np.concatenate([buf, np.empty(max(len(buf), 64), np.float32)])
+        buf[i] = latency
+        self._lat_i[op] = i + 1
+
+    def _record_error(self, op: str, code, detail: str = ""):
+        """Count a failure by operation and status code / exception type"""
+        self.metrics['errors'][(op, code)] += 1
+        if detail:
+            self.metrics['last_error'][op] = detail[:100]
+
     def _uuid(self) -> str:
-        import uuid
         return str(uuid.uuid4())
 
     def _random_b64(self, byte_length: int) -> str:
-        import os
         return base64.b64encode(os.urandom(byte_length)).decode('ascii')
 
     def _hash_phone(self, phone: str) -> str:
         """SHA-256 hash of phone number"""
-        digits = ''.join(c for c in phone if c.isdigit())
+        digits = phone.translate(_NON_DIGITS)
         if len(digits) == 10:
             digits = '1' + digits
         return hashlib.sha256(digits.encode()).hexdigest()
@@ -306,14 +650,17 @@ async def main():
 
     tester = RelayStressTester(RELAY_URL, FIREBASE_ID_TOKEN)
 
-    # Phase 1: Register users
-    await tester.setup_users(NUM_USERS)
+    try:
+        # Phase 1: Register users
+        await tester.setup_users(NUM_USERS)
 
-    # Phase 2: Stress test message sending
-    await tester.stress_test_sends(NUM_MESSAGES, CONCURRENCY)
+        # Phase 2: Stress test message sending
+        await tester.stress_test_sends(NUM_MESSAGES, CONCURRENCY)
 
-    # Phase 3: Stress test inbox polling
-    await tester.stress_test_inbox_polling(duration_seconds=30)
+        # Phase 3: Stress test inbox polling
+        await tester.stress_test_inbox_polling(duration_seconds=30)
+    finally:
+        await tester.aclose()
 
     # Print metrics
     tester.print_metrics()